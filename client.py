@@ -1,14 +1,31 @@
+import time
+STARTUP_T0 = time.perf_counter() # Reference point for the cold-start budget
+
 import tkinter as tk
 from tkinter import scrolledtext, simpledialog, filedialog, messagebox
-from PIL import Image, ImageTk
 import socket
 import threading
 import os
-import time
 import io
+import contextlib
+import hashlib
+import random
 
 import protocol
-from media_utils import VideoCamera, AudioRecorder, AudioPlayer
+# media_utils (cv2, pyaudio) and PIL are imported lazily on the first call,
+# so users who only chat never pay for them.
+
+# Time allowed from process start until the login prompt is shown
+STARTUP_BUDGET_MS = 300
+
+# Reconnect backoff (seconds). Each wait is random in [0, min(CAP, BASE * 2^attempt)]
+# so clients dropped by the same server restart don't all come back at once.
+RECONNECT_BASE = 0.5
+RECONNECT_CAP = 15
+RECONNECT_GIVE_UP = 120
+
+# Read size when hashing files in downloads/
+HASH_BLOCK = 1024 * 1024
 
 class ClientApp:
     def __init__(self, root):
@@ -22,11 +39,41 @@ class ClientApp:
         self.is_connected = False
         self.target_user = "All" # "All" or specific username
         self.send_lock = threading.Lock() # Prevent socket contention
+        self.host = None
+        self.closing = False
+
+        # Session resumption
+        self.resume_token = None
+        self.last_sseq = 0 # Highest numbered packet received, sent back on RESUME
+        self.resuming = False # From losing the connection until the server answers RESUME
+        # Backoff state survives connections that drop again before the server answers
+        self.reconnect_attempt = 0
+        self.reconnect_deadline = None
         
         # Call State
         self.in_call = False
         self.call_window = None
         self.call_partner = None
+        self.group_call = False # In the current room's group call
+        self.group_tiles = {} # username -> video label in the group call window
+        self.peer_codecs = None # Audio codecs the other end accepts (negotiated per call)
+        self.call_mode = "voice"
+        self.stream_gen = 0 # Bumped to retire old send threads after a reconnect
+
+        # Media subsystem (loaded on first call)
+        self.media = None
+        self.media_lock = threading.Lock()
+        self.player = None
+        self.player_failed = False
+        self.warming_up = False
+
+        # Room file shares: hash -> local path of files we already hold
+        self.known_hashes = {}
+        self.hash_by_path = {} # path -> hash, so an overwritten file drops its old hash
+        self.files_lock = threading.Lock()
+        self.pending_uploads = {} # hash -> path, waiting for the server to ask
+        # Hashing downloads/ can take a while, keep it off the UI and listener threads
+        threading.Thread(target=self.index_downloads, daemon=True).start()
         
         # UI Layout
         self.setup_ui()
@@ -61,6 +108,7 @@ class ClientApp:
         tk.Button(tool_frame, text="Create Room", command=self.create_room).pack(side=tk.LEFT)
         
         # Call Buttons
+        tk.Button(tool_frame, text="Group Call", command=lambda: self.start_group_call("video"), bg="#673AB7", fg="white").pack(side=tk.RIGHT, padx=2)
         tk.Button(tool_frame, text="Video Call", command=lambda: self.start_call("video"), bg="#2196F3", fg="white").pack(side=tk.RIGHT, padx=2)
         tk.Button(tool_frame, text="Voice Call", command=lambda: self.start_call("voice"), bg="#FF9800", fg="white").pack(side=tk.RIGHT, padx=2)
 
@@ -78,9 +126,16 @@ class ClientApp:
         self.room_listbox.pack(padx=5, fill=tk.X)
         self.room_listbox.bind('<Double-1>', self.join_room)
 
+    def report_startup(self):
+        elapsed_ms = (time.perf_counter() - STARTUP_T0) * 1000
+        status = "OK" if elapsed_ms <= STARTUP_BUDGET_MS else "OVER BUDGET"
+        print(f"[STARTUP] Login prompt ready in {elapsed_ms:.0f} ms (budget {STARTUP_BUDGET_MS} ms) {status}")
+
     def connect_to_server(self):
+        self.report_startup()
         host = simpledialog.askstring("Server", "Enter Server IP:", initialvalue="127.0.0.1")
         if not host: host = "127.0.0.1"
+        self.host = host
         
         self.username = simpledialog.askstring("Login", "Choose Username:")
         if not self.username: self.root.quit()
@@ -94,6 +149,7 @@ class ClientApp:
                 protocol.send_packet(self.client_socket, protocol.CMD_LOGIN, {'username': self.username})
             
             self.is_connected = True
+            self.root.protocol("WM_DELETE_WINDOW", self.on_close)
             
             # Start Listening Thread
             threading.Thread(target=self.listen_server, daemon=True).start()
@@ -103,7 +159,79 @@ class ClientApp:
             messagebox.showerror("Error", f"Could not connect: {e}")
             self.root.quit()
 
+    def on_close(self):
+        """ Closing the window is a real logout, not a blip to recover from """
+        self.closing = True
+        try:
+            with self.send_lock:
+                protocol.send_packet(self.client_socket, protocol.CMD_LOGOUT, {})
+        except:
+            pass
+        self.root.destroy()
+
+    def reconnect(self):
+        """ Connects again with backoff and asks the server to RESUME our session """
+        if self.closing or not self.resume_token:
+            return False
+        if not self.resuming:
+            self.append_message("text", "System", "Connection lost, reconnecting...")
+            self.resuming = True
+            self.reconnect_deadline = time.monotonic() + RECONNECT_GIVE_UP
+        # A connection that was accepted but dropped before SESSION still counts as a failed attempt
+        while not self.closing and time.monotonic() < self.reconnect_deadline:
+            delay = min(RECONNECT_CAP, RECONNECT_BASE * 2 ** self.reconnect_attempt)
+            time.sleep(random.uniform(0, delay))
+            self.reconnect_attempt += 1
+            try:
+                sock = socket.create_connection((self.host, protocol.PORT), timeout=5)
+                sock.settimeout(None)
+            except OSError as e:
+                print(f"[RECONNECT] Attempt {self.reconnect_attempt} failed: {e}")
+                continue
+
+            with self.send_lock:
+                try:
+                    self.client_socket.close()
+                except:
+                    pass
+                self.client_socket = sock
+                protocol.send_packet(sock, protocol.CMD_RESUME,
+                                     {"token": self.resume_token, "last_seq": self.last_sseq})
+            return True
+        return False
+
+    def session_update(self, data):
+        """ Server answered our LOGIN or RESUME """
+        if data.get('token'):
+            self.resume_token = data['token']
+        if not self.resuming:
+            return
+        self.resuming = False
+        self.reconnect_attempt = 0
+        self.reconnect_deadline = None
+
+        if data.get('resumed'):
+            self.append_message("text", "System", "Reconnected.")
+            if self.in_call:
+                self.restart_call_streams()
+        else:
+            # Server forgot us (restart or expired session): log in from scratch
+            self.last_sseq = 0
+            with self.send_lock:
+                protocol.send_packet(self.client_socket, protocol.CMD_LOGIN, {'username': self.username})
+            self.append_message("text", "System", "Reconnected with a new session, messages sent meanwhile are lost.")
+            if self.in_call:
+                self.root.after(0, self.end_call)
+
     # --- Core Chat Logic ---
+
+    def send_command(self, cmd, data):
+        """ Sends a user action. Returns False, and tells the user, if it could not be sent. """
+        with self.send_lock:
+            sent = not self.resuming and protocol.send_packet(self.client_socket, cmd, data)
+        if not sent:
+            self.append_message("text", "System", "Not connected, that was not sent. Try again once reconnected.")
+        return sent
     
     def select_user(self, event):
         selection = self.user_listbox.curselection()
@@ -125,13 +253,9 @@ class ClientApp:
         text = self.msg_entry.get()
         if not text: return
         
-        with self.send_lock:
-            if self.target_user == "All":
-                # Public
-                protocol.send_packet(self.client_socket, protocol.CMD_MSG, {"text": text, "to": "All"})
-            else:
-                # Private
-                protocol.send_packet(self.client_socket, protocol.CMD_MSG, {"text": text, "to": self.target_user})
+        # "All" is a room message, anything else is private
+        if not self.send_command(protocol.CMD_MSG, {"text": text, "to": self.target_user}):
+            return # Keep the text so it can be sent again
             
         self.msg_entry.delete(0, tk.END)
 
@@ -139,18 +263,16 @@ class ClientApp:
         room_name = simpledialog.askstring("Room", "New Room Name:")
         if room_name:
             password = simpledialog.askstring("Password", "Set Room Password (optional):", show='*')
-            with self.send_lock:
-                protocol.send_packet(self.client_socket, protocol.CMD_ROOM_JOIN, {"room": room_name, "password": password})
+            self.send_command(protocol.CMD_ROOM_JOIN, {"room": room_name, "password": password})
 
     def join_room(self, event):
         selection = self.room_listbox.curselection()
         if selection:
             room = self.room_listbox.get(selection[0])
             password = simpledialog.askstring("Password", f"Enter Password for {room} (if any):", show='*')
-            with self.send_lock:
-                protocol.send_packet(self.client_socket, protocol.CMD_ROOM_JOIN, {"room": room, "password": password})
+            self.send_command(protocol.CMD_ROOM_JOIN, {"room": room, "password": password})
 
-    def append_message(self, msg_type, sender, content):
+    def append_message(self, msg_type, sender, content, extra_tag=None):
         self.chat_area.config(state='normal')
         timestamp = time.strftime("%H:%M")
         
@@ -160,7 +282,8 @@ class ClientApp:
             self.chat_area.insert(tk.END, f"[{timestamp}] (PVT) {sender}: {content}\n", "private")
             self.chat_area.tag_config("private", foreground="red")
         elif msg_type == "file":
-             self.chat_area.insert(tk.END, f"[{timestamp}] {sender} sent a file: {content}\n", "file")
+             tags = ("file", extra_tag) if extra_tag else "file"
+             self.chat_area.insert(tk.END, f"[{timestamp}] {sender} sent a file: {content}\n", tags)
              self.chat_area.tag_config("file", foreground="blue")
              
         self.chat_area.see(tk.END)
@@ -179,16 +302,93 @@ class ClientApp:
         with open(filepath, "rb") as f:
             file_bytes = f.read()
             
+        if self.target_user == "All":
+            # Room share: announce the hash, the server asks for the bytes only if it needs them
+            digest = hashlib.sha256(file_bytes).hexdigest()
+            self.pending_uploads[digest] = filepath
+            self.remember_file(digest, filepath)
+            data = {"filename": filename, "size": file_size, "hash": digest}
+            if self.send_command(protocol.CMD_FILE_OFFER, data):
+                self.append_message("text", "Me", f"Shared file: {filename}")
+            return
+
         data = {
             "filename": filename,
             "size": file_size,
             "content": file_bytes,
-            "to": self.target_user if self.target_user != "All" else None
+            "to": self.target_user
         }
         
-        with self.send_lock:
-            protocol.send_packet(self.client_socket, protocol.CMD_FILE, data)
-        self.append_message("text", "Me", f"Sent file: {filename}")
+        if self.send_command(protocol.CMD_FILE, data):
+            self.append_message("text", "Me", f"Sent file: {filename}")
+
+    def upload_requested(self, digest):
+        """ Server does not hold this hash yet, send the content """
+        filepath = self.pending_uploads.pop(digest, None)
+        if not filepath: return
+        try:
+            with open(filepath, "rb") as f:
+                file_bytes = f.read()
+        except OSError as e:
+            print(f"[FILE] Could not read {filepath}: {e}")
+            return
+        data = {"filename": os.path.basename(filepath), "size": len(file_bytes), "content": file_bytes}
+        self.send_command(protocol.CMD_FILE, data)
+
+    def index_downloads(self):
+        """ Hashes the files already in downloads/ so offers for them aren't fetched again """
+        if not os.path.isdir("downloads"): return
+        for name in os.listdir("downloads"):
+            path = os.path.join("downloads", name)
+            try:
+                sha = hashlib.sha256()
+                with open(path, "rb") as f:
+                    # In blocks, so a large video doesn't have to fit in memory
+                    for block in iter(lambda: f.read(HASH_BLOCK), b''):
+                        sha.update(block)
+                digest = sha.hexdigest()
+            except OSError:
+                continue
+            with self.files_lock:
+                # Saved again while we were hashing: the newer entry is the right one
+                if path not in self.hash_by_path:
+                    self.hash_by_path[path] = digest
+                    self.known_hashes[digest] = path
+
+    def remember_file(self, digest, path):
+        with self.files_lock:
+            old = self.hash_by_path.get(path)
+            if old and self.known_hashes.get(old) == path:
+                # The file at this path was overwritten, its old content is gone
+                del self.known_hashes[old]
+            self.hash_by_path[path] = digest
+            self.known_hashes[digest] = path
+
+    def known_path(self, digest):
+        """ Local path of a file with this hash, or None. Files not indexed yet count as missing. """
+        with self.files_lock:
+            return self.known_hashes.get(digest)
+
+    def show_file_offer(self, offer):
+        """ Adds a clickable line to the chat; the file is only downloaded on click """
+        digest = offer['hash']
+        sender = offer['from']
+        filename = offer['filename']
+        path = self.known_path(digest)
+        if path:
+            self.append_message("file", sender, f"{filename} (already in {path})")
+            return
+
+        tag = f"offer_{digest}"
+        size_kb = offer['size'] / 1024
+        self.append_message("file", sender, f"{filename} ({size_kb:.0f} KB) - click to download", tag)
+        self.chat_area.tag_config(tag, underline=True)
+        self.chat_area.tag_bind(tag, "<Button-1>", lambda e: self.fetch_file(offer))
+
+    def fetch_file(self, offer):
+        if self.known_path(offer['hash']): return
+        data = {"hash": offer['hash'], "filename": offer['filename'], "from": offer['from']}
+        self.send_command(protocol.CMD_FILE_FETCH, data)
 
     def save_incoming_file(self, filename, content):
         # Auto save to 'Downloads' folder in project dir
@@ -200,11 +400,50 @@ class ClientApp:
 
     # --- Video/Voice Calling (Threaded) ---
 
+    def load_media(self):
+        """ Imports media_utils on first use. Safe to call from any thread. """
+        with self.media_lock:
+            if self.media is None:
+                t0 = time.perf_counter()
+                import media_utils
+                self.media = media_utils
+                print(f"[MEDIA] Media subsystem loaded in {(time.perf_counter() - t0) * 1000:.0f} ms")
+        return self.media
+
+    def warm_up_media(self, video=False):
+        """ Opens audio output (and loads video libs) in the background when a call starts """
+        with self.media_lock:
+            if self.warming_up:
+                return
+            self.warming_up = True
+        threading.Thread(target=self._warm_up, args=(video,), daemon=True).start()
+
+    def _warm_up(self, video):
+        try:
+            media = self.load_media()
+            if self.player is None and not self.player_failed:
+                player = media.AudioPlayer()
+                if player.stream:
+                    self.player = player
+                else:
+                    self.player_failed = True
+            if video:
+                media.get_cv2()
+                import PIL.ImageTk # preload for update_call_video
+        except Exception as e:
+            print(f"[WARNING] Media warm-up failed: {e}")
+            self.player_failed = True
+        finally:
+            self.warming_up = False
+
     def start_call(self, mode="video"):
         if self.target_user == "All":
             messagebox.showwarning("Call", "Select a user from the list to call.")
             return
             
+        # Open devices in the background while the window comes up
+        self.warm_up_media(video=(mode == "video"))
+
         # Open Call Window
         self.setup_call_window(target=self.target_user, incoming=False, mode=mode)
         
@@ -215,6 +454,70 @@ class ClientApp:
         # Audio is always sent in both modes
         threading.Thread(target=self.send_audio_stream, args=(self.target_user,), daemon=True).start()
 
+    def start_group_call(self, mode="video"):
+        """ Joins the group call of the current room (the server creates it if needed) """
+        if self.in_call:
+            messagebox.showwarning("Call", "You are already in a call.")
+            return
+
+        self.warm_up_media(video=(mode == "video"))
+        if not self.send_command(protocol.CMD_GROUP_CALL_JOIN,
+                                 {"video": mode == "video", "codecs": self.load_media().CODECS}):
+            return
+        self.setup_group_call_window()
+        self.call_mode = mode
+
+        # One uplink stream each, the server fans them out
+        if mode == "video":
+            threading.Thread(target=self.send_video_stream, args=(None,), daemon=True).start()
+        threading.Thread(target=self.send_audio_stream, args=(None,), daemon=True).start()
+
+    def setup_group_call_window(self):
+        self.in_call = True
+        self.group_call = True
+        self.group_tiles = {}
+        self.call_window = tk.Toplevel(self.root)
+        self.call_window.title("Group Call")
+        self.call_window.protocol("WM_DELETE_WINDOW", self.end_call)
+        self.call_window.geometry("760x480")
+
+        self.group_status = tk.Label(self.call_window, text="Joining call...", font=("Arial", 11))
+        self.group_status.pack(side=tk.TOP, fill=tk.X)
+        self.tiles_frame = tk.Frame(self.call_window, bg="black")
+        self.tiles_frame.pack(fill=tk.BOTH, expand=True)
+
+        end_btn = tk.Button(self.call_window, text="Leave Call", command=self.end_call,
+                           bg="#f44336", fg="white", font=("Arial", 12, "bold"))
+        end_btn.pack(side=tk.BOTTOM, fill=tk.X, pady=5, padx=5)
+
+    def update_group_call(self, state):
+        """ Participants/speakers changed; keep one tile per remote participant """
+        if not self.group_call or not self.call_window: return
+        others = [u for u in state['participants'] if u != self.username]
+        for user in list(self.group_tiles):
+            if user not in others:
+                self.group_tiles.pop(user).destroy()
+        for user in others:
+            if user not in self.group_tiles:
+                self.group_tiles[user] = tk.Label(self.tiles_frame, text=user, bg="#222", fg="white",
+                                                  width=30, height=12, compound=tk.BOTTOM)
+        for i, user in enumerate(others):
+            self.group_tiles[user].grid(row=i // 3, column=i % 3, padx=2, pady=2)
+            speaking = user in state['speakers']
+            self.group_tiles[user].config(fg="#4CAF50" if speaking else "white")
+        self.group_status.config(text=f"Group call in {state['room']} - {len(state['participants'])} participants")
+
+    def update_group_video(self, sender, frame_bytes):
+        tile = self.group_tiles.get(sender)
+        if not self.group_call or tile is None: return
+        try:
+            from PIL import Image, ImageTk
+            photo = ImageTk.PhotoImage(Image.open(io.BytesIO(frame_bytes)))
+            tile.configure(image=photo, width=0, height=0)
+            tile.image = photo # keep reference
+        except Exception as e:
+            print(f"[GUI ERROR] Update group video failed: {e}")
+
     def setup_call_window(self, target, incoming=False, mode="video"):
         if self.call_window: 
             # If already in call (e.g. voice), and upgrading to video, handle it?
@@ -222,6 +525,7 @@ class ClientApp:
             return 
             
         self.in_call = True
+        self.call_mode = mode
         self.call_partner = target
         self.call_window = tk.Toplevel(self.root)
         
@@ -247,16 +551,30 @@ class ClientApp:
                            bg="#f44336", fg="white", font=("Arial", 12, "bold"))
         end_btn.pack(side=tk.BOTTOM, fill=tk.X, pady=5, padx=5)
 
-    def end_call(self):
+    def end_call(self, notify=True):
+        """ Leaves the current call; notify=False when the server already ended our part in it """
+        if notify and self.group_call and self.client_socket:
+            try:
+                with self.send_lock:
+                    protocol.send_packet(self.client_socket, protocol.CMD_GROUP_CALL_LEAVE, {})
+            except:
+                pass
         # Notify other user that call is ending
-        if self.call_partner and self.client_socket:
+        elif notify and self.call_partner and self.client_socket:
             try:
                 with self.send_lock:
                     protocol.send_packet(self.client_socket, protocol.CMD_END_CALL, {"target": self.call_partner})
             except:
                 pass
         
+        if self.player:
+            print(f"[AUDIO] Jitter buffer stats: {self.player.stats()}")
+            self.player.jitter.reset()
+
         self.in_call = False
+        self.group_call = False
+        self.group_tiles = {}
+        self.peer_codecs = None
         if self.call_window:
             try:
                 self.call_window.destroy()
@@ -265,9 +583,23 @@ class ClientApp:
             self.call_window = None
         self.call_partner = None
 
+    @staticmethod
+    def media_route(target):
+        """ 1:1 calls name a target, group calls (target None) go to the room's call """
+        return {"target": target} if target else {"group": True}
+
+    def restart_call_streams(self):
+        """ Send threads stop when the socket dies; start fresh ones on the resumed connection """
+        self.stream_gen += 1
+        target = None if self.group_call else self.call_partner
+        if self.call_mode == "video":
+            threading.Thread(target=self.send_video_stream, args=(target,), daemon=True).start()
+        threading.Thread(target=self.send_audio_stream, args=(target,), daemon=True).start()
+
     def send_video_stream(self, target):
+        gen = self.stream_gen
         try:
-            camera = VideoCamera()
+            camera = self.load_media().VideoCamera()
             if camera.cap is None:
                 # Camera not available
                 self.root.after(0, lambda: messagebox.showerror(
@@ -283,12 +615,13 @@ class ClientApp:
             ))
             return
             
-        while self.in_call and self.is_connected:
+        while self.in_call and self.is_connected and gen == self.stream_gen:
             try:
                 frame_bytes = camera.get_frame_bytes()
                 if frame_bytes and self.client_socket:
                     # Send via server (encrypted again to match receiver expectation)
-                    data = {"target": target, "frame": frame_bytes}
+                    data = self.media_route(target)
+                    data["frame"] = frame_bytes
                     with self.send_lock:
                         if not protocol.send_packet(self.client_socket, protocol.CMD_VIDEO, data, is_encrypted=True):
                             print("[VIDEO] Failed to send frame")
@@ -300,8 +633,9 @@ class ClientApp:
         camera.cleanup()
 
     def send_audio_stream(self, target):
+        gen = self.stream_gen
         try:
-            mic = AudioRecorder()
+            mic = self.load_media().AudioRecorder()
             if mic.audio is None:
                 print("[WARNING] Audio device not available")
                 return
@@ -313,11 +647,32 @@ class ClientApp:
             print(f"[ERROR] Failed to initialize microphone: {e}")
             return
             
-        while self.in_call and self.is_connected:
+        media = self.load_media()
+        vad = media.VoiceActivityDetector()
+        silent_run = 0
+        seq = 0
+        while self.in_call and self.is_connected and gen == self.stream_gen:
             try:
                 chunk = mic.get_chunk()
                 if chunk and self.client_socket:
-                    data = {"target": target, "chunk": chunk}
+                    # seq/ts feed the receiver's jitter buffer; seq also counts suppressed chunks
+                    seq += 1
+                    data = self.media_route(target)
+                    data["seq"] = seq
+                    data["ts"] = time.monotonic()
+                    data["accept"] = media.CODECS
+                    if vad.is_speech(chunk):
+                        silent_run = 0
+                        # Plain PCM until the other side tells us what it can decode
+                        codec = media.pick_codec(self.peer_codecs)
+                        data["codec"] = codec
+                        data["chunk"] = media.encode_audio(chunk, codec)
+                    else:
+                        # Silence: send only a comfort noise level now and then
+                        silent_run += 1
+                        if silent_run % media.CN_REFRESH != 1:
+                            continue
+                        data["cn"] = vad.noise_level()
                     with self.send_lock:
                         if not protocol.send_packet(self.client_socket, protocol.CMD_AUDIO, data, is_encrypted=True):
                             print("[AUDIO] Failed to send chunk")
@@ -329,10 +684,27 @@ class ClientApp:
                 break
         mic.stop()
 
+    def play_audio(self, data, sequenced=True):
+        """ Decodes an audio packet into the player. Returns False if the player isn't ready. """
+        player = self.player
+        if not player or not player.stream:
+            return False
+        if 'cn' in data:
+            if sequenced:
+                player.comfort_noise(data['cn'])
+            return True
+        pcm = self.media.decode_audio(data['chunk'], data.get('codec', "pcm"))
+        if sequenced:
+            player.receive(pcm, data.get('seq'), data.get('ts'))
+        else:
+            player.play(pcm)
+        return True
+
     def update_call_video(self, frame_bytes):
         # Called from network thread
         if not self.in_call or not self.call_window: return
         try:
+            from PIL import Image, ImageTk
             image = Image.open(io.BytesIO(frame_bytes))
             photo = ImageTk.PhotoImage(image)
             self.video_label.configure(image=photo, text="") # Clear text when video arrives
@@ -343,35 +715,43 @@ class ClientApp:
     # --- Network Listener ---
 
     def listen_server(self):
-        # Audio player is persistent to reduce lag in startup
-        try:
-            player = AudioPlayer()
-        except Exception as e:
-            print(f"[WARNING] Audio player initialization failed: {e}")
-            player = None
-        
+        # The audio player is opened by warm_up_media when the first call starts
         while self.is_connected:
             try:
                 packet = protocol.receive_packet(self.client_socket)
                 if not packet:
                     print("Disconnected from server")
-                    self.is_connected = False
-                    break
             except OSError as e:
                 if e.errno == 10054:
                     print("Connection forcibly closed by server.")
                 else:
                     print(f"Socket Error: {e}")
-                self.is_connected = False
-                break
+                packet = None
             except Exception as e:
                 print(f"Receive Error: {e}")
+                packet = None
+
+            if not packet:
+                # Try to resume the session before giving up on the app
+                if self.reconnect():
+                    continue
                 self.is_connected = False
                 break
                 
             cmd = packet['type']
             data = packet['data']
 
+            # Numbered packets may arrive twice around a RESUME
+            sseq = data.get('sseq') if isinstance(data, dict) else None
+            if sseq:
+                if sseq <= self.last_sseq:
+                    continue
+                self.last_sseq = sseq
+
+            if cmd == protocol.CMD_SESSION:
+                self.session_update(data)
+                continue
+
             if cmd == protocol.CMD_LIST_UPDATE:
                 users = data['users']
                 rooms = data['rooms']
@@ -401,13 +781,43 @@ class ClientApp:
                 sender = data['from']
                 filename = data['filename']
                 path = self.save_incoming_file(filename, data['content'])
+                # Private files come without a hash; record one anyway since the path may have held another file
+                self.remember_file(data.get('hash') or hashlib.sha256(data['content']).hexdigest(), path)
                 self.append_message("file", sender, f"{filename} (Saved in downloads/)")
 
+            elif cmd == protocol.CMD_FILE_OFFER:
+                self.show_file_offer(data)
+
+            elif cmd == protocol.CMD_FILE_FETCH:
+                # Upload off the listener thread so big files don't stall receiving
+                threading.Thread(target=self.upload_requested, args=(data['hash'],), daemon=True).start()
+
+            elif cmd in (protocol.CMD_VIDEO, protocol.CMD_AUDIO) and data.get('group'):
+                # Selectively forwarded group call stream
+                if not self.group_call:
+                    continue
+                if cmd == protocol.CMD_VIDEO:
+                    sender, frame = data.get('sender'), data['frame']
+                    self.root.after(0, lambda s=sender, f=frame: self.update_group_video(s, f))
+                else:
+                    # Unmixed streams from several senders share no sequence
+                    self.play_audio(data, sequenced=data.get('mixed', False))
+
+            elif cmd == protocol.CMD_GROUP_CALL_UPDATE:
+                if data.get('ended'):
+                    # We switched rooms, the server already took us out of the old room's call
+                    if self.group_call:
+                        self.root.after(0, lambda: self.end_call(notify=False))
+                    continue
+                self.peer_codecs = data.get('codecs')
+                self.root.after(0, lambda state=data: self.update_group_call(state))
+
             elif cmd == protocol.CMD_VIDEO:
                 # If we are not in call, we should probably open window or notify
                 # For this demo: Open window automatically if receiving frames
                 if not self.in_call:
                      sender = data.get('sender')
+                     self.warm_up_media(video=True)
                      self.root.after(0, lambda: self.setup_call_window(target=sender, incoming=True, mode="video"))
                      self.in_call = True
                      
@@ -423,24 +833,32 @@ class ClientApp:
                 # If receiving audio but not in call, it's a voice call
                 if not self.in_call:
                      sender = data.get('sender')
+                     self.warm_up_media()
                      self.root.after(0, lambda: self.setup_call_window(target=sender, incoming=True, mode="voice"))
                      self.in_call = True
                      
                      # Start sending back audio only (Voice Call)
                      threading.Thread(target=self.send_audio_stream, args=(sender,), daemon=True).start()
 
-                # Play directly in thread (audio is non-blocking)
-                if player and player.stream:
-                    chunk = data['chunk']
-                    player.play(chunk)
+                if data.get('accept'):
+                    self.peer_codecs = data['accept']
+
+                # Queue in the player's jitter buffer, its own thread plays it out.
+                # Chunks that arrive while the player is still warming up are dropped.
+                if not self.play_audio(data) and not self.player_failed:
+                    self.warm_up_media()
             
+            elif cmd == protocol.CMD_THROTTLE:
+                # Server is rate limiting us
+                self.append_message("text", "System", data['text'])
+
             elif cmd == protocol.CMD_END_CALL:
                 # Other user ended the call
                 self.root.after(0, self.end_call)
                 self.root.after(0, lambda: messagebox.showinfo("Call Ended", "The other user ended the call."))
         
-        if player:
-            player.cleanup()
+        if self.player:
+            self.player.cleanup()
         try:
             if self.client_socket:
                 self.client_socket.close()
@@ -452,6 +870,8 @@ class ClientApp:
             pass
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = ClientApp(root)
-    root.mainloop()
\ No newline at end of file
+    # Set PYCHAT_TRACE=client_trace.json to record per-packet timings
+    with protocol.tracer_from_env() or contextlib.nullcontext():
+        root = tk.Tk()
+        app = ClientApp(root)
+        root.mainloop()
\ No newline at end of file
@@ -0,0 +1,111 @@
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+STORE_DIR = "server_files"
+MAX_STORE_BYTES = 500 * 1024 * 1024 # Oldest-used files are evicted above this
+
+_DIGEST_RE = re.compile(r'[0-9a-f]{64}')
+
+def file_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+def is_valid_hash(digest):
+    return isinstance(digest, str) and _DIGEST_RE.fullmatch(digest) is not None
+
+class FileStore:
+    """
+    Content-addressed file store. Each upload is saved once under its
+    SHA-256 hash, so reposting the same file costs no extra disk or upload.
+    Total size is bounded; the least recently used files are evicted first.
+    """
+    def __init__(self, root=STORE_DIR, max_bytes=MAX_STORE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        # hash -> size, least recently used first
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._load_index()
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _load_index(self):
+        """ Rebuilds the LRU order from file modification times """
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not is_valid_hash(name):
+                    continue
+                stat = os.stat(os.path.join(dirpath, name))
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, digest, size in sorted(found):
+            self.index[digest] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _touch(self, digest):
+        self.index.move_to_end(digest)
+        try:
+            os.utime(self._path(digest))
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Always keep the newest file, even if it alone exceeds the limit
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            digest, size = self.index.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+            print(f"[FILESTORE] Evicted {digest[:12]} ({size} bytes)")
+
+    def size(self, digest):
+        """ Size of a stored file, or None if we don't hold it """
+        with self.lock:
+            if digest in self.index:
+                self._touch(digest)
+                return self.index[digest]
+            return None
+
+    def put(self, content):
+        """ Stores content (if new) and returns its hash """
+        digest = file_hash(content)
+        with self.lock:
+            if digest in self.index:
+                self._touch(digest)
+                return digest
+
+            path = self._path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+            self.index[digest] = len(content)
+            self.total_bytes += len(content)
+            self._evict()
+        return digest
+
+    def get(self, digest):
+        """ Returns the stored bytes or None if unknown/evicted """
+        if not is_valid_hash(digest):
+            return None
+        with self.lock:
+            if digest not in self.index:
+                return None
+            self._touch(digest)
+            try:
+                with open(self._path(digest), "rb") as f:
+                    return f.read()
+            except OSError:
+                # File vanished behind our back
+                self.total_bytes -= self.index.pop(digest)
+                return None
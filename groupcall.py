@@ -0,0 +1,87 @@
+import time
+
+from ratelimit import TokenBucket
+from media_utils import chunk_level, pick_codec, CODECS
+
+# Only this many participants have their video forwarded at once
+MAX_VIDEO_STREAMS = 3
+# Default per-receiver video budget (bytes/second). ~10 fps JPEG at 240x180 is 5-8 KB/frame.
+VIDEO_BUDGET = 160 * 1024
+# Clients may ask for a different budget, but never more than this
+MAX_VIDEO_BUDGET = 2 * 1024 * 1024
+# Mean absolute sample value above which a chunk counts as speech
+SPEECH_LEVEL = 500
+
+class Participant:
+    def __init__(self, username, video=True, video_budget=VIDEO_BUDGET, codecs=None):
+        self.username = username
+        self.video = video
+        # Codec for audio sent *to* this participant
+        self.codec = pick_codec(codecs)
+        self.joined = time.monotonic()
+        self.last_spoke = 0.0
+        # Downlink budget for video forwarded *to* this participant
+        self.budget = TokenBucket(video_budget, video_budget)
+
+class GroupCall:
+    """
+    Selective forwarding for one room's call. Every participant uploads a
+    single audio and video stream; the server decides per receiver which
+    streams to pass on. Audio goes to everyone (mixed, if a mixer is set),
+    video only from the most recent active speakers and only while the
+    receiver's budget allows it.
+    Callers must hold the server lock.
+    """
+    def __init__(self, room):
+        self.room = room
+        self.participants = {} # username -> Participant
+        self.speakers = []
+        # Server-side AudioMixer when numpy is available, else audio is forwarded as-is
+        self.mixer = None
+
+    def add(self, username, video=True, video_budget=None, codecs=None):
+        self.participants[username] = Participant(username, video, video_budget or VIDEO_BUDGET, codecs)
+        self.speakers = self._pick_speakers()
+
+    def remove(self, username):
+        self.participants.pop(username, None)
+        self.speakers = self._pick_speakers()
+
+    def is_empty(self):
+        return not self.participants
+
+    def _pick_speakers(self):
+        # Most recent speakers first; people who never spoke in join order
+        ranked = sorted((p for p in self.participants.values() if p.video),
+                        key=lambda p: (-p.last_spoke, p.joined))
+        return [p.username for p in ranked[:MAX_VIDEO_STREAMS]]
+
+    def update_level(self, username, pcm):
+        """ Feeds a decoded audio chunk; returns True if the active speaker set changed """
+        participant = self.participants.get(username)
+        if participant is None:
+            return False
+        if not pcm or chunk_level(pcm) < SPEECH_LEVEL:
+            return False
+        participant.last_spoke = time.monotonic()
+        speakers = self._pick_speakers()
+        if set(speakers) == set(self.speakers):
+            return False
+        self.speakers = speakers
+        return True
+
+    def audio_receivers(self, sender):
+        return [u for u in self.participants if u != sender]
+
+    def video_receivers(self, sender, frame_size):
+        if sender not in self.speakers:
+            return []
+        receivers = []
+        for username, participant in self.participants.items():
+            if username != sender and participant.budget.try_consume(frame_size):
+                receivers.append(username)
+        return receivers
+
+    def state(self):
+        return {"room": self.room, "participants": list(self.participants), "speakers": list(self.speakers),
+                "codecs": list(CODECS)}
@@ -1,17 +1,164 @@
-import cv2
-import pyaudio
 import threading
+import time
+import math
+import random
+from array import array
+
+# cv2 and pyaudio are heavy (native libs, device enumeration), so they are
+# only imported when a recorder/player/camera is actually created.
+_pyaudio = None
+_cv2 = None
+_audio_interface = None
+_load_lock = threading.Lock()
 
 # Audio Config
-FORMAT = pyaudio.paInt16
+SAMPLE_WIDTH = 2 # 16-bit PCM (pyaudio.paInt16)
 CHANNELS = 1
 RATE = 16000 # Reduced from 44100 to save bandwidth
 CHUNK = 1024
 
+def get_pyaudio():
+    global _pyaudio
+    with _load_lock:
+        if _pyaudio is None:
+            import pyaudio
+            _pyaudio = pyaudio
+    return _pyaudio
+
+def get_cv2():
+    global _cv2
+    with _load_lock:
+        if _cv2 is None:
+            import cv2
+            _cv2 = cv2
+    return _cv2
+
+def get_audio_interface():
+    """ One shared PyAudio instance; creating it enumerates every device """
+    global _audio_interface
+    pyaudio = get_pyaudio()
+    with _load_lock:
+        if _audio_interface is None:
+            _audio_interface = pyaudio.PyAudio()
+    return _audio_interface
+
+def audio_format():
+    return get_pyaudio().paInt16
+
+# --- Audio encoding ---
+# Codecs we can send/receive, in order of preference. ulaw is G.711 mu-law:
+# 8 bits per sample, half the size of raw 16-bit PCM.
+CODECS = ("ulaw", "pcm")
+ULAW_BIAS = 0x84
+ULAW_CLIP = 32635
+_ulaw_enc = None # 65536 entries, indexed by the sample as unsigned 16-bit
+_ulaw_dec = None # 256 entries of 2-byte little-endian PCM
+
+def _ulaw_byte(sample):
+    sign = 0x80 if sample < 0 else 0
+    if sign:
+        sample = -sample
+    sample = min(sample, ULAW_CLIP) + ULAW_BIAS
+    exponent = sample.bit_length() - 8
+    mantissa = (sample >> (exponent + 3)) & 0x0F
+    return ~(sign | (exponent << 4) | mantissa) & 0xFF
+
+def _ulaw_sample(byte):
+    byte = ~byte & 0xFF
+    exponent = (byte >> 4) & 0x07
+    sample = ((((byte & 0x0F) << 3) + ULAW_BIAS) << exponent) - ULAW_BIAS
+    return -sample if byte & 0x80 else sample
+
+def _ulaw_tables():
+    global _ulaw_enc, _ulaw_dec
+    with _load_lock:
+        if _ulaw_enc is None:
+            _ulaw_enc = bytes(_ulaw_byte(s - 65536 if s >= 32768 else s) for s in range(65536))
+            _ulaw_dec = [array('h', [_ulaw_sample(b)]).tobytes() for b in range(256)]
+    return _ulaw_enc, _ulaw_dec
+
+def pcm_samples(pcm):
+    samples = array('h')
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % 2])
+    return samples
+
+def encode_audio(pcm, codec):
+    if codec == "ulaw":
+        enc, _ = _ulaw_tables()
+        return bytes(enc[s & 0xFFFF] for s in pcm_samples(pcm))
+    return pcm
+
+def decode_audio(data, codec):
+    """ Returns 16-bit PCM for a chunk sent with the given codec """
+    if codec == "ulaw":
+        _, dec = _ulaw_tables()
+        return b''.join(dec[b] for b in data)
+    return data
+
+def pick_codec(peer_codecs):
+    """ First of our codecs the peer also accepts """
+    for codec in CODECS:
+        if codec in (peer_codecs or ()):
+            return codec
+    return "pcm"
+
+# --- Voice activity detection ---
+VAD_THRESHOLD = 300 # Mean absolute level that always counts as silence below it
+VAD_RATIO = 3.0 # Speech must be this much louder than the background noise
+VAD_HANGOVER = 5 # Chunks still sent after speech stops (~320 ms), so word ends aren't cut
+VAD_WARMUP = 8 # Chunks (~0.5 s) watched before the noise floor is trusted
+VAD_FLOOR_RISE = 0.005 # Per-chunk rise of the noise floor during speech (~2x in 9 s)
+CN_REFRESH = 15 # Re-send the comfort noise level every ~1 s of silence
+LEVEL_STRIDE = 8 # Every Nth sample is enough to estimate loudness
+
+def chunk_level(pcm):
+    """ Rough loudness (mean absolute sample) of a 16-bit PCM chunk """
+    sampled = pcm_samples(pcm)[::LEVEL_STRIDE]
+    if not sampled:
+        return 0
+    return sum(abs(s) for s in sampled) / len(sampled)
+
+class VoiceActivityDetector:
+    """ Energy based speech detector with an adaptive noise floor and hangover """
+    def __init__(self):
+        self.noise_floor = None
+        self.chunks_seen = 0
+        self.hangover = 0
+
+    def is_speech(self, pcm):
+        level = chunk_level(pcm)
+        self.chunks_seen += 1
+        if self.chunks_seen <= VAD_WARMUP:
+            # No single chunk is trusted as the background (the user may already be talking):
+            # take the quietest of the first few and use the fixed threshold meanwhile
+            self.noise_floor = level if self.noise_floor is None else min(self.noise_floor, level)
+            speech = level > VAD_THRESHOLD
+        else:
+            speech = level > max(VAD_THRESHOLD, self.noise_floor * VAD_RATIO)
+            if level < self.noise_floor:
+                # Quieter than we thought: follow it down quickly
+                self.noise_floor += (level - self.noise_floor) * 0.5
+            elif speech:
+                # Minimum tracking: creep up even during "speech", so a background that
+                # got louder is eventually learned instead of counting as speech forever
+                self.noise_floor = min(level, self.noise_floor * (1 + VAD_FLOOR_RISE) + 1)
+            else:
+                self.noise_floor += (level - self.noise_floor) * 0.05
+        if not speech:
+            if self.hangover > 0:
+                self.hangover -= 1
+                return True
+            return False
+        self.hangover = VAD_HANGOVER
+        return True
+
+    def noise_level(self):
+        return int(self.noise_floor or 0)
+
 class AudioRecorder:
     def __init__(self):
         try:
-            self.audio = pyaudio.PyAudio()
+            self.audio = get_audio_interface()
             self.stream = None
             self.recording = False
         except Exception as e:
@@ -25,7 +172,7 @@ class AudioRecorder:
             return
         try:
             self.recording = True
-            self.stream = self.audio.open(format=FORMAT, channels=CHANNELS,
+            self.stream = self.audio.open(format=audio_format(), channels=CHANNELS,
                                           rate=RATE, input=True,
                                           frames_per_buffer=CHUNK)
         except Exception as e:
@@ -50,26 +197,224 @@ class AudioRecorder:
             except:
                 pass
 
+# Jitter buffer tuning (in chunks of CHUNK samples, 64 ms each)
+JITTER_MIN_DEPTH = 1
+JITTER_MAX_DEPTH = 8
+# Buffer this many chunks above target before time-compressing
+JITTER_DRIFT = 2
+# Consecutive concealed chunks before we give up and re-buffer
+MAX_CONCEALED = 3
+CONCEAL_FADE = 0.6
+# Samples cut from a chunk when compressing, and the cross-fade at the seam
+COMPRESS_SAMPLES = CHUNK // 4
+CROSSFADE = 64
+
+def _scale(chunk, gain):
+    samples = pcm_samples(chunk)
+    return array('h', (int(s * gain) for s in samples)).tobytes()
+
+def _compress(chunk):
+    """ Shortens a chunk by COMPRESS_SAMPLES, cross-fading across the cut """
+    samples = pcm_samples(chunk)
+    cut = len(samples) // 2 - COMPRESS_SAMPLES // 2
+    fade = min(CROSSFADE, cut)
+    head = samples[:cut]
+    # The tail overlaps the head by `fade` samples, which get blended
+    tail = samples[cut + COMPRESS_SAMPLES - fade:]
+    for i in range(fade):
+        w = (i + 1) / (fade + 1)
+        a = head[len(head) - fade + i]
+        b = tail[i]
+        head[len(head) - fade + i] = int(a * (1 - w) + b * w)
+    return (head + tail[fade:]).tobytes()
+
+def _comfort_noise(level, samples=CHUNK):
+    # Uniform noise in [-2L, 2L] has a mean absolute value of L
+    amplitude = max(1, min(2 * level, 2000))
+    return array('h', (random.randint(-amplitude, amplitude) for _ in range(samples))).tobytes()
+
+class JitterBuffer:
+    """
+    Adaptive receive buffer for one audio stream. Chunks are ordered by
+    sequence number; the playout delay follows the measured interarrival
+    jitter (RFC 3550 style). Late chunks are dropped, missing ones are
+    concealed by fading out the last good chunk, and when the buffer runs
+    deeper than needed chunks are time-compressed to bring latency down.
+    While the sender signals silence, comfort noise is played instead.
+    """
+    def __init__(self, period=CHUNK / RATE):
+        self.period = period
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.chunks = {} # seq -> pcm bytes
+            self.next_seq = None
+            self.buffering = True
+            self.last_chunk = None
+            self.concealed_run = 0
+            self.jitter = 0.0
+            self.prev_transit = None
+            self.cn_level = None # Set while the sender is suppressing silence
+            self.counters = {"played": 0, "concealed": 0, "late": 0, "overflow": 0,
+                             "compressed": 0, "underruns": 0, "comfort_noise": 0}
+
+    def target_depth(self):
+        depth = math.ceil(4 * self.jitter / self.period) + 1
+        return max(JITTER_MIN_DEPTH, min(JITTER_MAX_DEPTH, depth))
+
+    def push(self, seq, data, ts=None):
+        arrival = time.monotonic()
+        with self.lock:
+            if self.next_seq is not None and seq < self.next_seq:
+                if self.next_seq - seq > 50:
+                    # Sender restarted its sequence (new call); start over
+                    self.chunks.clear()
+                    self.next_seq = None
+                    self.buffering = True
+                else:
+                    self.counters["late"] += 1
+                    return
+
+            if ts is not None:
+                transit = arrival - ts
+                if self.prev_transit is not None:
+                    d = abs(transit - self.prev_transit)
+                    self.jitter += (d - self.jitter) / 16
+                self.prev_transit = transit
+
+            if self.cn_level is not None:
+                # Speech resumed after a silence period, re-sync on the new chunks
+                self.cn_level = None
+                self.buffering = True
+
+            # Peers may send a stray odd byte; keep whole 16-bit samples only
+            self.chunks[seq] = data[:len(data) - len(data) % 2]
+            # Never hold more than the maximum delay
+            while len(self.chunks) > JITTER_MAX_DEPTH + JITTER_DRIFT:
+                oldest = min(self.chunks)
+                del self.chunks[oldest]
+                self.counters["overflow"] += 1
+                if self.next_seq is not None and oldest >= self.next_seq:
+                    self.next_seq = oldest + 1
+
+    def push_comfort_noise(self, level):
+        """ Sender stopped sending chunks because it detected silence """
+        with self.lock:
+            self.cn_level = level
+
+    def _comfort_noise(self):
+        if self.cn_level is None:
+            return None
+        self.counters["comfort_noise"] += 1
+        return _comfort_noise(self.cn_level)
+
+    def pop(self):
+        """ Next chunk to play, a concealment/comfort noise chunk, or None while (re)buffering """
+        with self.lock:
+            if self.buffering:
+                if len(self.chunks) < self.target_depth():
+                    return self._comfort_noise()
+                self.buffering = False
+                self.next_seq = min(self.chunks)
+
+            chunk = self.chunks.pop(self.next_seq, None)
+            if chunk is None and not self.chunks and self.cn_level is not None:
+                # Silence period, nothing is missing
+                return self._comfort_noise()
+            self.next_seq += 1
+            if chunk is not None:
+                self.concealed_run = 0
+                self.last_chunk = chunk
+                self.counters["played"] += 1
+                if len(self.chunks) > self.target_depth() + JITTER_DRIFT:
+                    self.counters["compressed"] += 1
+                    return _compress(chunk)
+                return chunk
+
+            if not self.chunks:
+                self.counters["underruns"] += 1
+            if self.last_chunk is None or self.concealed_run >= MAX_CONCEALED:
+                self.buffering = True
+                return None
+            # Loss concealment: replay the last chunk, fading out
+            self.concealed_run += 1
+            self.counters["concealed"] += 1
+            return _scale(self.last_chunk, CONCEAL_FADE ** self.concealed_run)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["depth"] = len(self.chunks)
+            stats["target_depth"] = self.target_depth()
+            stats["jitter_ms"] = round(self.jitter * 1000, 1)
+            return stats
+
 class AudioPlayer:
     def __init__(self):
+        self.jitter = JitterBuffer()
+        self.playing = False
+        self.thread = None
+        # Set whenever the jitter buffer may have something new to play
+        self.wake = threading.Event()
         try:
-            self.audio = pyaudio.PyAudio()
-            self.stream = self.audio.open(format=FORMAT, channels=CHANNELS,
+            self.audio = get_audio_interface()
+            self.stream = self.audio.open(format=audio_format(), channels=CHANNELS,
                                           rate=RATE, output=True,
                                           frames_per_buffer=CHUNK)
+            # The blocking stream.write paces the playout thread at the device clock
+            self.playing = True
+            self.thread = threading.Thread(target=self._playout, daemon=True)
+            self.thread.start()
         except Exception as e:
             print(f"[ERROR] Failed to initialize audio player: {e}")
             self.audio = None
             self.stream = None
 
     def play(self, data):
+        """ Writes a chunk straight to the device (no sequence info available) """
         if self.stream:
             try:
                 self.stream.write(data)
             except:
                 pass
+
+    def receive(self, data, seq=None, ts=None):
+        """ Queues a sequenced chunk in the jitter buffer; unsequenced chunks play directly """
+        if seq is None:
+            self.play(data)
+        else:
+            self.jitter.push(seq, data, ts)
+            self.wake.set()
+
+    def comfort_noise(self, level):
+        self.jitter.push_comfort_noise(level)
+        self.wake.set()
+
+    def _playout(self):
+        while self.playing:
+            self.wake.clear()
+            try:
+                chunk = self.jitter.pop()
+                if chunk is None:
+                    # (Re)buffering only ends when something arrives, so sleep until then
+                    self.wake.wait()
+                    continue
+                self.play(chunk)
+            except Exception as e:
+                # One bad chunk must not end playout for the rest of the session
+                print(f"[AUDIO] Playout error: {e}")
+
+    def stats(self):
+        return self.jitter.stats()
             
     def cleanup(self):
+        self.playing = False
+        self.wake.set()
+        # The playout thread may be inside stream.write; let it finish before closing the stream
+        if self.thread:
+            self.thread.join(timeout=1.0)
         if self.stream:
             try:
                 self.stream.stop_stream()
@@ -79,8 +424,10 @@ class AudioPlayer:
 
 class VideoCamera:
     def __init__(self):
+        self.cv2 = None
         try:
-            self.cap = cv2.VideoCapture(0) # Open default camera
+            self.cv2 = get_cv2()
+            self.cap = self.cv2.VideoCapture(0) # Open default camera
             if not self.cap.isOpened():
                 print("[WARNING] Camera not available")
                 self.cap = None
@@ -95,6 +442,7 @@ class VideoCamera:
             ret, frame = self.cap.read()
             if ret:
                 # Downscale more for network performance (smaller resolution = less data)
+                cv2 = self.cv2
                 frame = cv2.resize(frame, (240, 180))
                 # Compress to JPEG with lower quality for speed
                 success, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 30])
@@ -0,0 +1,150 @@
+import time
+import threading
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from media_utils import RATE, CHUNK
+
+# Chunks an input must have queued before it is mixed (absorbs network jitter)
+MIX_PREBUFFER = 2
+# Older chunks are dropped beyond this so latency can't grow without bound
+MIX_MAX_QUEUE = 6
+# How fast the limiter gain recovers after a loud peak (0..1 per chunk)
+GAIN_RELEASE = 0.05
+
+class _Input:
+    def __init__(self):
+        self.frames = deque()
+        self.pending = np.zeros(0, dtype=np.int16)
+        self.primed = False
+
+class AudioMixer:
+    """
+    Mixes the 16 kHz int16 PCM chunks of a group call so each listener gets
+    one stream: everybody else's voice, without their own. Mixing runs on its
+    own clock (one chunk period per tick) and each input is jitter-buffered,
+    so bursty arrivals still line up. A per-listener limiter prevents clipping.
+    """
+    def __init__(self, send_fn, rate=RATE, chunk=CHUNK):
+        self.send_fn = send_fn # send_fn(username, pcm_bytes or None for silence, seq, ts)
+        self.rate = rate
+        self.chunk = chunk
+        self.inputs = {} # username -> _Input
+        self.gains = {} # username -> current limiter gain
+        self.hearing = set() # Listeners that got a mix on the last tick
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    @staticmethod
+    def available():
+        return np is not None
+
+    def add(self, username):
+        with self.lock:
+            self.inputs.setdefault(username, _Input())
+            self.gains.setdefault(username, 1.0)
+
+    def remove(self, username):
+        with self.lock:
+            self.inputs.pop(username, None)
+            self.gains.pop(username, None)
+            self.hearing.discard(username)
+
+    def push(self, username, chunk):
+        """ Queues raw PCM from a participant, re-framed to exact chunk size """
+        if not chunk:
+            return
+        samples = np.frombuffer(chunk[:len(chunk) - len(chunk) % 2], dtype='<i2')
+        with self.lock:
+            inp = self.inputs.get(username)
+            if inp is None:
+                return
+            pending = np.concatenate((inp.pending, samples))
+            while len(pending) >= self.chunk:
+                inp.frames.append(pending[:self.chunk])
+                pending = pending[self.chunk:]
+            inp.pending = pending
+            while len(inp.frames) > MIX_MAX_QUEUE:
+                inp.frames.popleft()
+
+    def mix_once(self):
+        """
+        Produces one chunk per listener. Returns {username: pcm_bytes}.
+        A listener whose mix just went quiet maps to None (once), so its jitter
+        buffer can be told about the silence instead of concealing a "loss".
+        """
+        with self.lock:
+            out = self._mix()
+            stopped = self.hearing - set(out)
+            self.hearing = set(out)
+        out.update(dict.fromkeys(stopped))
+        return out
+
+    def _mix(self):
+        names = list(self.inputs)
+        if len(names) < 2:
+            return {}
+        frames = np.zeros((len(names), self.chunk), dtype=np.int32)
+        active = np.zeros(len(names), dtype=bool)
+        for i, name in enumerate(names):
+            inp = self.inputs[name]
+            if not inp.primed and len(inp.frames) >= MIX_PREBUFFER:
+                inp.primed = True
+            if inp.primed:
+                if inp.frames:
+                    frames[i] = inp.frames.popleft()
+                    active[i] = True
+                else:
+                    # Underrun: wait for the buffer to fill up again
+                    inp.primed = False
+        if not active.any():
+            return {}
+
+        # Everyone's sum minus each listener's own voice, all at once
+        mixes = frames.sum(axis=0)[None, :] - frames
+        peaks = np.abs(mixes).max(axis=1)
+        target = np.minimum(1.0, 32767 / np.maximum(peaks, 1))
+        gains = np.array([self.gains[name] for name in names])
+        # Attack instantly, release slowly so the level doesn't pump
+        gains = np.where(target < gains, target, gains + (target - gains) * GAIN_RELEASE)
+        for name, gain in zip(names, gains):
+            self.gains[name] = float(gain)
+
+        out = np.clip(mixes * gains[:, None], -32768, 32767).astype('<i2')
+        # Listeners only hear something if somebody else is talking
+        others_active = active.sum() - active
+        return {name: out[i].tobytes() for i, name in enumerate(names) if others_active[i]}
+
+    def _run(self):
+        period = self.chunk / self.rate
+        next_tick = time.monotonic()
+        seq = 0
+        while self.running:
+            next_tick += period
+            seq += 1
+            try:
+                # seq/ts let the receivers' jitter buffers order and time the mix
+                ts = time.monotonic()
+                for name, pcm in self.mix_once().items():
+                    self.send_fn(name, pcm, seq, ts)
+            except Exception as e:
+                print(f"[MIXER ERROR] {e}")
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Fell behind; don't burst to catch up
+                next_tick = time.monotonic()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,82 @@
+import socket
+import threading
+from collections import deque
+
+import protocol
+
+# Media packets queued for one receiver before new ones are dropped (~0.5 s of audio + video)
+OUTBOX_MEDIA_LIMIT = 16
+# A receiver this far behind has stopped reading; its connection is cut so it can RESUME
+OUTBOX_MAX_BYTES = 64 * 1024 * 1024
+
+def _packet_size(data):
+    payload = data.get('content') or data.get('frame') or data.get('chunk') or b''
+    return len(payload) + 64
+
+class Outbox:
+    """
+    Send queue for one connection, drained by its own writer thread.
+    Routing code only queues packets, so a slow receiver never blocks the
+    sender's thread, the scheduler or the mixer clock. Packets go out in the
+    order they were queued. Media is dropped once the receiver falls behind;
+    everything else is kept until OUTBOX_MAX_BYTES, then the connection is closed.
+    """
+    def __init__(self, sock, media_limit=OUTBOX_MEDIA_LIMIT, max_bytes=OUTBOX_MAX_BYTES):
+        self.sock = sock
+        self.media_limit = media_limit
+        self.max_bytes = max_bytes
+        self.queue = deque() # (cmd, data, size, droppable)
+        self.queued_bytes = 0
+        self.queued_media = 0
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, cmd, data, droppable=False):
+        """ Queues a packet. Returns False if it was dropped. """
+        size = _packet_size(data)
+        with self.cond:
+            if self.closed:
+                return False
+            if droppable and self.queued_media >= self.media_limit:
+                self.dropped += 1
+                return False
+            # A single packet bigger than the cap (a large file) still goes out on its own
+            overflow = self.queue and self.queued_bytes + size > self.max_bytes
+            if not overflow:
+                self.queue.append((cmd, data, size, droppable))
+                self.queued_bytes += size
+                self.queued_media += droppable
+                self.cond.notify()
+                return True
+        print(f"[OUTBOX] Receiver fell {self.queued_bytes} bytes behind, closing connection")
+        self.close()
+        return False
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                cmd, data, size, droppable = self.queue.popleft()
+                self.queued_bytes -= size
+                self.queued_media -= droppable
+            if not protocol.send_packet(self.sock, cmd, data):
+                self.close()
+                return
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.clear()
+            self.cond.notify_all()
+        try:
+            # Wakes up the connection's reader so it cleans up as usual
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
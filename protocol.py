@@ -2,6 +2,12 @@ import socket
 import struct
 import msgpack
 import threading
+import time
+import os
+import json
+import random
+import weakref
+from contextlib import ContextDecorator
 from cryptography.fernet import Fernet
 
 # Generate a fixed key for the "university project" simplicity scope
@@ -21,11 +27,150 @@ CMD_MSG = "MSG"
 CMD_PRIVATE = "PVT"
 CMD_ROOM_JOIN = "JOIN_ROOM"
 CMD_FILE = "FILE"
+# Room shares: metadata {filename, size, hash} announced to the room.
+# FILE_FETCH {hash} asks the other side for the bytes of that hash
+# (client -> server to download, server -> uploader to request an upload).
+CMD_FILE_OFFER = "FILE_OFFER"
+CMD_FILE_FETCH = "FILE_FETCH"
 CMD_VIDEO = "VIDEO_FRAME"
 CMD_AUDIO = "AUDIO_CHUNK"
 CMD_LIST_UPDATE = "LIST"
 CMD_ACCEPT_CALL = "ACCEPT_CALL"
 CMD_END_CALL = "END_CALL"
+# Group calls (one per room). Media packets sent with {"group": True}
+# are selectively forwarded by the server to the other participants.
+CMD_GROUP_CALL_JOIN = "GROUP_CALL_JOIN"
+CMD_GROUP_CALL_LEAVE = "GROUP_CALL_LEAVE"
+CMD_GROUP_CALL_UPDATE = "GROUP_CALL_UPDATE"
+CMD_THROTTLE = "THROTTLE"
+# Sessions: the server answers LOGIN/RESUME with SESSION {token, resumed}.
+# RESUME {token, last_seq} re-attaches a dropped session and replays packets
+# numbered (sseq) after last_seq. LOGOUT ends the session right away.
+CMD_SESSION = "SESSION"
+CMD_RESUME = "RESUME"
+CMD_LOGOUT = "LOGOUT"
+
+# --- PROFILING HOOKS ---
+# Hooks are called as hook(direction, cmd_type, stages, size) where
+# direction is "send"/"recv", stages is a list of (stage_name, start, end)
+# perf_counter timestamps and size is the on-wire payload length.
+# When no hook is installed the send/receive path takes no timestamps.
+_profile_hooks = []
+
+def add_profile_hook(hook):
+    if hook not in _profile_hooks:
+        _profile_hooks.append(hook)
+
+def remove_profile_hook(hook):
+    if hook in _profile_hooks:
+        _profile_hooks.remove(hook)
+
+def _emit_profile(direction, cmd_type, stages, size):
+    for hook in list(_profile_hooks):
+        try:
+            hook(direction, cmd_type, stages, size)
+        except Exception as e:
+            print(f"[PROFILE HOOK ERROR] {e}")
+
+class PacketTracer(ContextDecorator):
+    """
+    Records per-stage packet timings (pack, encrypt, send / recv, decrypt, unpack)
+    grouped by command type. Works as a context manager or decorator:
+
+        with PacketTracer(trace_path="server_trace.json", sample_rate=0.1):
+            ...
+
+    On exit the hook is removed and, if trace_path is set, the events are
+    written as Chrome trace JSON (open in chrome://tracing or Perfetto).
+    """
+    def __init__(self, trace_path=None, sample_rate=1.0, max_events=200000):
+        self.trace_path = trace_path
+        self.sample_rate = sample_rate
+        self.max_events = max_events
+        self.events = []
+        # (direction, cmd_type, stage) -> [count, total_seconds, max_seconds]
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def record(self, direction, cmd_type, stages, size):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        tid = threading.get_ident()
+        with self.lock:
+            for stage, start, end in stages:
+                key = (direction, cmd_type, stage)
+                entry = self.stats.setdefault(key, [0, 0.0, 0.0])
+                duration = end - start
+                entry[0] += 1
+                entry[1] += duration
+                entry[2] = max(entry[2], duration)
+
+                if len(self.events) < self.max_events:
+                    self.events.append({
+                        "name": stage, "cat": f"{direction}:{cmd_type}", "ph": "X",
+                        "ts": (start - self.origin) * 1e6, "dur": duration * 1e6,
+                        "pid": os.getpid(), "tid": tid,
+                        "args": {"cmd": cmd_type, "bytes": size}
+                    })
+
+    def summary(self):
+        """ Returns {(direction, cmd, stage): {"count", "avg_ms", "max_ms"}} """
+        with self.lock:
+            return {key: {"count": c, "avg_ms": total / c * 1000, "max_ms": peak * 1000}
+                    for key, (c, total, peak) in self.stats.items()}
+
+    def print_summary(self):
+        for (direction, cmd_type, stage), s in sorted(self.summary().items()):
+            print(f"[TRACE] {direction:4} {cmd_type:12} {stage:8} "
+                  f"n={s['count']:<6} avg={s['avg_ms']:.3f}ms max={s['max_ms']:.3f}ms")
+
+    def export_chrome_trace(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def __enter__(self):
+        add_profile_hook(self.record)
+        return self
+
+    def __exit__(self, *exc):
+        remove_profile_hook(self.record)
+        self.print_summary()
+        if self.trace_path:
+            try:
+                self.export_chrome_trace(self.trace_path)
+                print(f"[TRACE] Wrote {len(self.events)} events to {self.trace_path}")
+            except OSError as e:
+                print(f"[TRACE] Could not write trace: {e}")
+        return False
+
+def tracer_from_env():
+    """
+    Builds a PacketTracer from PYCHAT_TRACE (output path) and
+    PYCHAT_TRACE_SAMPLE (0..1). Returns None when tracing is not requested.
+    """
+    path = os.environ.get("PYCHAT_TRACE")
+    if not path:
+        return None
+    try:
+        rate = float(os.environ.get("PYCHAT_TRACE_SAMPLE", "1.0"))
+    except ValueError:
+        rate = 1.0
+    return PacketTracer(trace_path=path, sample_rate=rate)
+
+# One lock per socket so packets from different threads (e.g. several group
+# call participants forwarding to the same receiver) never interleave.
+_send_locks = weakref.WeakKeyDictionary()
+_send_locks_guard = threading.Lock()
+
+def _send_lock(sock):
+    with _send_locks_guard:
+        lock = _send_locks.get(sock)
+        if lock is None:
+            lock = _send_locks[sock] = threading.Lock()
+        return lock
 
 def send_packet(sock, cmd_type, data_dict, is_encrypted=True):
     """
@@ -40,18 +185,28 @@ def send_packet(sock, cmd_type, data_dict, is_encrypted=True):
         if sock is None or sock.fileno() == -1:
             return False
             
+        profiling = bool(_profile_hooks)
+        if profiling: t0 = time.perf_counter()
+
         payload = {'type': cmd_type, 'data': data_dict}
         packed_payload = msgpack.packb(payload)
+        if profiling: t1 = time.perf_counter()
         
         final_payload = packed_payload
         if is_encrypted:
              final_payload = cipher.encrypt(packed_payload)
+        if profiling: t2 = time.perf_counter()
         
         length = len(final_payload)
         # >I means Big-Endian Unsigned Integer (Standard Network Byte Order)
         header = struct.pack('>I', length) 
         
-        sock.sendall(header + final_payload)
+        with _send_lock(sock):
+            sock.sendall(header + final_payload)
+        if profiling:
+            t3 = time.perf_counter()
+            _emit_profile("send", cmd_type,
+                          [("pack", t0, t1), ("encrypt", t1, t2), ("send", t2, t3)], length)
         return True
     except OSError as e:
         # Socket-specific errors (including WinError 10038)
@@ -78,6 +233,9 @@ def receive_packet(sock, is_encrypted=True):
             header += chunk
         
         payload_length = struct.unpack('>I', header)[0]
+        # Idle time waiting for the header is not counted as recv time
+        profiling = bool(_profile_hooks)
+        if profiling: t0 = time.perf_counter()
         
         # Read Body
         payload = b''
@@ -88,10 +246,18 @@ def receive_packet(sock, is_encrypted=True):
             chunk = sock.recv(read_size)
             if not chunk: return None
             payload += chunk
+        if profiling: t1 = time.perf_counter()
             
         if is_encrypted:
             payload = cipher.decrypt(payload)
+        if profiling: t2 = time.perf_counter()
             
-        return msgpack.unpackb(payload, raw=False) # unpack to python dict
+        packet = msgpack.unpackb(payload, raw=False) # unpack to python dict
+        if profiling:
+            t3 = time.perf_counter()
+            cmd_type = packet.get('type') if isinstance(packet, dict) else None
+            _emit_profile("recv", cmd_type,
+                          [("recv", t0, t1), ("decrypt", t1, t2), ("unpack", t2, t3)], payload_length)
+        return packet
     except Exception as e:
         return None
\ No newline at end of file
@@ -0,0 +1,140 @@
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import protocol
+
+# Limits per command class: (tokens per second, burst size)
+# file_bytes is measured in bytes, everything else in packets.
+RATE_LIMITS = {
+    "chat": (5, 10),
+    "file_bytes": (2 * 1024 * 1024, 10 * 1024 * 1024),
+    "media": (60, 120),
+    "join": (0.5, 3),
+    "fetch": (2, 10),
+}
+
+# Don't spam the offender with a notice for every dropped packet
+NOTICE_INTERVAL = 2.0
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def try_consume(self, amount=1):
+        """ Takes tokens if available. Returns False (and takes nothing) otherwise. """
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def consume_with_debt(self, amount):
+        """
+        Always takes the tokens, letting the bucket go negative.
+        Returns how many seconds the caller should wait to pay the debt back.
+        """
+        self._refill()
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def retry_after(self, amount=1):
+        self._refill()
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+class RateLimiter:
+    """ One set of token buckets per connected user """
+    def __init__(self, limits=RATE_LIMITS):
+        self.buckets = {name: TokenBucket(rate, burst) for name, (rate, burst) in limits.items()}
+        self.last_notice = {}
+
+    @staticmethod
+    def classify(cmd, data):
+        """ Maps a packet to (limit_class, cost) or (None, 0) if it is not limited """
+        if cmd in (protocol.CMD_MSG, protocol.CMD_FILE_OFFER):
+            # An offer is announced to the whole room like a chat line
+            return "chat", 1
+        if cmd == protocol.CMD_FILE:
+            content = data.get('content') or b''
+            return "file_bytes", len(content)
+        if cmd in (protocol.CMD_VIDEO, protocol.CMD_AUDIO):
+            return "media", 1
+        if cmd in (protocol.CMD_ROOM_JOIN, protocol.CMD_GROUP_CALL_JOIN, protocol.CMD_GROUP_CALL_LEAVE,
+                   protocol.CMD_LOGIN, protocol.CMD_RESUME):
+            # Each of these sets up or tears down server state (rooms, calls, mixers, sessions)
+            return "join", 1
+        if cmd == protocol.CMD_FILE_FETCH:
+            return "fetch", 1
+        return None, 0
+
+    def check(self, cmd, data):
+        """
+        Returns (allowed, delay, limit_class).
+        Chat, media and joins are dropped when their bucket is empty.
+        File bytes are never dropped; instead delay tells the server how long to
+        stop reading from this client so TCP backpressure slows the upload down.
+        """
+        limit_class, cost = self.classify(cmd, data)
+        bucket = self.buckets.get(limit_class)
+        if bucket is None:
+            return True, 0.0, None
+
+        if limit_class == "file_bytes":
+            return True, bucket.consume_with_debt(cost), limit_class
+
+        if bucket.try_consume(cost):
+            return True, 0.0, limit_class
+        return False, bucket.retry_after(cost), limit_class
+
+    def should_notify(self, limit_class):
+        now = time.monotonic()
+        if now - self.last_notice.get(limit_class, 0) < NOTICE_INTERVAL:
+            return False
+        self.last_notice[limit_class] = now
+        return True
+
+class FairScheduler:
+    """
+    Round-robin gate for packet processing. At most max_active connections
+    route a packet at once; the rest wait in arrival order. Each connection
+    joins the back of the queue again for its next packet, so under load a
+    spamming client gets one turn per round like everybody else.
+    Turns are meant for routing only: socket writes happen in the
+    connections' outboxes, so a slow receiver can't hold a slot.
+    """
+    def __init__(self, max_active=4):
+        self.max_active = max_active
+        self.active = 0
+        self.waiting = deque()
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def turn(self):
+        ticket = object()
+        with self.cond:
+            self.waiting.append(ticket)
+            while self.waiting[0] is not ticket or self.active >= self.max_active:
+                self.cond.wait()
+            self.waiting.popleft()
+            self.active += 1
+            # The next waiter may be able to go as well
+            self.cond.notify_all()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
@@ -1,6 +1,18 @@
 import socket
 import threading
+import contextlib
+import time
 import protocol
+from ratelimit import RateLimiter, FairScheduler
+from outbox import Outbox
+from filestore import FileStore, is_valid_hash
+from groupcall import GroupCall, MAX_VIDEO_BUDGET
+from mixer import AudioMixer
+from media_utils import decode_audio, encode_audio
+from session import Session, SESSION_GRACE, REPLAYED_COMMANDS
+
+# List changes within this window go out as one broadcast (e.g. everyone logging in again after a restart)
+LIST_UPDATE_DELAY = 0.5
 
 class ChatServer:
     def __init__(self):
@@ -18,6 +30,20 @@ class ChatServer:
         self.rooms = {"General": {"users": [], "password": None}} 
         
         self.lock = threading.Lock()
+        # Round-robin packet processing across connections under load
+        self.scheduler = FairScheduler()
+        # Per-connection send queues: socket -> Outbox. Routing never writes to a socket itself,
+        # so a slow receiver can't hold up a scheduler turn.
+        self.outboxes = {}
+        # Room file shares are stored once and fetched on demand
+        self.file_store = FileStore()
+        # Group calls: room_name -> GroupCall
+        self.group_calls = {}
+        # Sessions survive a dropped connection for SESSION_GRACE seconds
+        self.sessions = {} # resume token -> Session
+        self.user_sessions = {} # username -> Session
+        self.list_update_pending = False
+        threading.Thread(target=self.reap_sessions, daemon=True).start()
 
         print(f"[SERVER] Running on port {protocol.ADDR[1]}")
         print(f"[SERVER] Local IP Address: {self.get_local_ip()}")
@@ -37,45 +63,315 @@ class ChatServer:
     def broadcast(self, msg_packet, exclude_socket=None, target_room=None):
         """ Send packet to all or specific room members """
         with self.lock:
-            targets = []
             if target_room:
                 room_data = self.rooms.get(target_room)
-                if room_data:
-                    users = room_data["users"]
-                    for user in users:
-                        sock = self.username_to_socket.get(user)
-                        if sock: targets.append(sock)
+                users = list(room_data["users"]) if room_data else []
             else:
-                targets = list(self.clients.keys())
+                users = list(self.user_sessions)
 
-        for client_socket in targets:
-            if client_socket != exclude_socket:
-                try:
-                    # Check if socket is still valid
-                    if client_socket and client_socket.fileno() != -1:
-                        protocol.send_packet(client_socket, msg_packet['type'], msg_packet['data'])
-                except Exception as e:
-                    print(f"[BROADCAST ERROR] {e}")
+        for user in users:
+            session = self.user_sessions.get(user)
+            if session is None or (exclude_socket is not None and session.sock is exclude_socket):
+                continue
+            try:
+                self.deliver(user, msg_packet['type'], msg_packet['data'])
+            except Exception as e:
+                print(f"[BROADCAST ERROR] {e}")
+
+    def send(self, sock, cmd, data, droppable=False):
+        """ Queues a packet on a connection; media should be droppable """
+        outbox = self.outboxes.get(sock)
+        if outbox is None:
+            return False
+        return outbox.put(cmd, data, droppable)
+
+    def deliver(self, username, cmd, data):
+        """ Sends to a logged-in user; chat and file packets are also kept for RESUME """
+        session = self.user_sessions.get(username)
+        if session is None:
+            return False
+        # Numbering and queueing happen together, so packets reach the socket in sseq order
+        with session.lock:
+            if cmd in REPLAYED_COMMANDS:
+                data = session.record(cmd, data)
+            # Away users only get the packet recorded
+            return self.send(session.sock, cmd, data)
 
     def handle_private_msg(self, sender, target_user, text):
-        target_socket = self.username_to_socket.get(target_user)
-        if target_socket:
+        if target_user in self.user_sessions:
             data = {"from": sender, "text": text, "is_private": True}
-            protocol.send_packet(target_socket, protocol.CMD_MSG, data)
+            self.deliver(target_user, protocol.CMD_MSG, data)
             # Send acknowledgment back to sender
-            protocol.send_packet(self.username_to_socket[sender], protocol.CMD_MSG, data)
+            self.deliver(sender, protocol.CMD_MSG, data)
 
-    def send_active_list(self):
-        """ Sends updated user list to everyone """
-        users = list(self.username_to_socket.keys())
-        rooms_list = list(self.rooms.keys())
-        
-        packet = {"users": users, "rooms": rooms_list}
-        self.broadcast({'type': protocol.CMD_LIST_UPDATE, 'data': packet})
+    # --- Sessions ---
+
+    def start_session(self, username, client_socket):
+        with self.lock:
+            old = self.user_sessions.get(username)
+        if old:
+            # Logging in again under the same name replaces the old session
+            self.end_session(old, announce=False)
+
+        session = Session(username, client_socket)
+        if old:
+            session.limiter = old.limiter
+        with self.lock:
+            self.sessions[session.token] = session
+            self.user_sessions[username] = session
+            self.clients[client_socket] = username
+            self.username_to_socket[username] = client_socket
+            self.rooms["General"]["users"].append(username)
+        self.send(client_socket, protocol.CMD_SESSION, {"token": session.token, "resumed": False})
+        return session
+
+    def resume_session(self, client_socket, token, last_seq):
+        """ Re-attaches a session to a new connection and replays what the client missed """
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is not None and self.user_sessions.get(session.username) is not session:
+                session = None
+
+        if session is None:
+            # Unknown or expired token (e.g. the server restarted): client must LOGIN
+            self.send(client_socket, protocol.CMD_SESSION, {"resumed": False})
+            return None
+
+        # deliver() waits on session.lock, so nothing new is numbered or queued for this
+        # user until the SESSION reply and the replay are queued ahead of it
+        with session.lock:
+            if self.user_sessions.get(session.username) is not session:
+                # The reaper ended it while we were looking it up
+                self.send(client_socket, protocol.CMD_SESSION, {"resumed": False})
+                return None
+            old_sock = session.sock
+            session.sock = client_socket
+            session.away_since = None
+            self.send(client_socket, protocol.CMD_SESSION,
+                      {"token": session.token, "resumed": True, "room": session.room})
+            packets, gap = session.missed(last_seq)
+            if gap:
+                self.send(client_socket, protocol.CMD_MSG,
+                          {"from": "System", "text": "Some older messages could not be replayed."})
+            for cmd, data in packets:
+                self.send(client_socket, cmd, data)
+
+        with self.lock:
+            if old_sock is not None:
+                self.clients.pop(old_sock, None)
+            self.clients[client_socket] = session.username
+            self.username_to_socket[session.username] = client_socket
+        if old_sock is not None:
+            # We had not noticed the old connection die yet. Its thread is still blocked in
+            # recv; shutting the socket down wakes it so its own cleanup runs.
+            old_outbox = self.outboxes.get(old_sock)
+            if old_outbox:
+                old_outbox.close()
+            else:
+                try:
+                    old_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        # Only the returning client needs fresh lists, nobody else saw it leave
+        self.send_active_list(target_socket=client_socket)
+        if session.call:
+            self.join_group_call(session.username, session.room, session.call)
+        print(f"[RESUME] {session.username} resumed, replayed {len(packets)} packets")
+        return session
+
+    def park_session(self, session, sock):
+        """ Connection sock dropped: keep name and room, wait for RESUME """
+        if self.user_sessions.get(session.username) is not session or session.sock is not sock:
+            return
+        # Media can't reach an away user; session.call is kept and rejoined on RESUME
+        self.leave_group_call(session.username, session.room)
+        with session.lock:
+            # A RESUME may have moved the session to a new connection meanwhile
+            if session.sock is not sock:
+                return
+            session.park()
+        with self.lock:
+            self.clients.pop(sock, None)
+            if self.username_to_socket.get(session.username) is sock:
+                del self.username_to_socket[session.username]
+
+    def end_session(self, session, announce=True, only_if_expired=False):
+        """ Returns False if only_if_expired was set and the user came back in time """
+        # Held throughout so a RESUME can't re-attach the session while it is being removed
+        with session.lock:
+            if only_if_expired and not session.expired(time.monotonic()):
+                return False
+            current = self.user_sessions.get(session.username) is session
+            if current:
+                self.leave_group_call(session.username, session.room)
+            with self.lock:
+                self.sessions.pop(session.token, None)
+                if current:
+                    del self.user_sessions[session.username]
+                    self.clients.pop(session.sock, None)
+                    self.username_to_socket.pop(session.username, None)
+                    room_data = self.rooms.get(session.room)
+                    if room_data and session.username in room_data["users"]:
+                        room_data["users"].remove(session.username)
+        if current and announce:
+            self.send_active_list()
+        return True
+
+    def reap_sessions(self):
+        """ Ends sessions whose users did not come back within SESSION_GRACE """
+        while True:
+            time.sleep(5)
+            with self.lock:
+                sessions = list(self.user_sessions.values())
+            for session in sessions:
+                # Checked again under the session lock, a RESUME may be arriving right now
+                if session.expired(time.monotonic()) and self.end_session(session, only_if_expired=True):
+                    print(f"[DISCONN] {session.username} (session expired)")
+
+    def notify_throttle(self, client_socket, limit_class, retry_after, dropped=True):
+        """ Tells the offending client that it is being rate limited """
+        if dropped:
+            text = f"You are sending {limit_class} too fast. Packet dropped, retry in {retry_after:.1f}s."
+        else:
+            text = f"Upload rate limited, slowing down for {retry_after:.1f}s."
+        self.send(client_socket, protocol.CMD_THROTTLE,
+                             {"class": limit_class, "retry_after": retry_after, "dropped": dropped, "text": text})
+
+    def announce_file(self, sender, room, filename, size, digest, exclude_socket=None):
+        """ Tells a room a file is available without pushing its content """
+        offer = {"from": sender, "room": room, "filename": filename, "size": size, "hash": digest}
+        self.broadcast({'type': protocol.CMD_FILE_OFFER, 'data': offer}, exclude_socket=exclude_socket, target_room=room)
+
+    def send_group_call_state(self, call):
+        """ Tells every participant who is in the call and whose video is forwarded """
+        with self.lock:
+            state = call.state()
+            targets = [self.username_to_socket.get(u) for u in call.participants]
+        for sock in targets:
+            self.send(sock, protocol.CMD_GROUP_CALL_UPDATE, state)
+
+    @staticmethod
+    def video_budget(value):
+        """ A client's requested video budget, clamped; None (use the default) if it isn't a positive number """
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0:
+            return None
+        return min(value, MAX_VIDEO_BUDGET)
+
+    def join_group_call(self, username, room, data):
+        with self.lock:
+            room_data = self.rooms.get(room)
+            if not room_data or username not in room_data["users"]:
+                return None
+            call = self.group_calls.get(room)
+            if call is None:
+                call = self.group_calls[room] = GroupCall(room)
+                if AudioMixer.available():
+                    call.mixer = AudioMixer(lambda user, pcm, seq, ts: self.send_mixed_audio(room, user, pcm, seq, ts))
+                    call.mixer.start()
+            codecs = data.get('codecs')
+            call.add(username, video=bool(data.get('video', True)), video_budget=self.video_budget(data.get('video_budget')),
+                     codecs=codecs if isinstance(codecs, list) else None)
+            if call.mixer:
+                call.mixer.add(username)
+        print(f"[GROUP CALL] {username} joined call in {room}")
+        self.send_group_call_state(call)
+        return call
+
+    def leave_group_call(self, username, room):
+        """ Returns True if the user was in the room's call """
+        with self.lock:
+            call = self.group_calls.get(room)
+            if call is None or username not in call.participants:
+                return False
+            call.remove(username)
+            if call.mixer:
+                call.mixer.remove(username)
+            if call.is_empty():
+                del self.group_calls[room]
+                if call.mixer:
+                    call.mixer.stop()
+        print(f"[GROUP CALL] {username} left call in {room}")
+        if not call.is_empty():
+            self.send_group_call_state(call)
+        return True
+
+    def send_mixed_audio(self, room, username, pcm, seq, ts):
+        """ Called from the room's mixer thread with one listener's mix """
+        with self.lock:
+            sock = self.username_to_socket.get(username)
+            call = self.group_calls.get(room)
+            participant = call.participants.get(username) if call else None
+        codec = participant.codec if participant else "pcm"
+        data = {"group": True, "mixed": True, "sender": room, "seq": seq, "ts": ts}
+        if pcm is None:
+            # Nobody else is talking any more: play silence rather than conceal a "lost" chunk
+            data["cn"] = 0
+            self.send(sock, protocol.CMD_AUDIO, data)
+            return
+        data["codec"] = codec
+        data["chunk"] = encode_audio(pcm, codec)
+        # Queued, never written here: one stalled listener must not hold up the mixer clock
+        self.send(sock, protocol.CMD_AUDIO, data, droppable=True)
+
+    def forward_group_media(self, sender, room, cmd, data):
+        """ Selective forwarding: each receiver only gets the streams picked for it """
+        speakers_changed = False
+        pcm = None
+        if cmd == protocol.CMD_AUDIO and data.get('chunk'):
+            pcm = decode_audio(data['chunk'], data.get('codec', "pcm"))
+        with self.lock:
+            call = self.group_calls.get(room)
+            if call is None or sender not in call.participants:
+                return
+            if cmd == protocol.CMD_AUDIO:
+                speakers_changed = call.update_level(sender, pcm)
+                # With a mixer everyone gets one mixed stream instead of N-1 raw ones
+                receivers = [] if call.mixer else call.audio_receivers(sender)
+            else:
+                receivers = call.video_receivers(sender, len(data.get('frame') or b''))
+            targets = [self.username_to_socket.get(u) for u in receivers]
+
+        if cmd == protocol.CMD_AUDIO and call.mixer:
+            call.mixer.push(sender, pcm)
+
+        data['sender'] = sender
+        for sock in targets:
+            self.send(sock, cmd, data, droppable=True)
+        if speakers_changed:
+            self.send_group_call_state(call)
+
+    def active_list(self):
+        # Users who are briefly away stay listed so a blip doesn't churn everyone's list
+        with self.lock:
+            return {"users": list(self.user_sessions.keys()), "rooms": list(self.rooms.keys())}
+
+    def send_active_list(self, target_socket=None):
+        """ Sends updated user list to target_socket now, or to everyone within LIST_UPDATE_DELAY """
+        if target_socket:
+            self.send(target_socket, protocol.CMD_LIST_UPDATE, self.active_list())
+            return
+        with self.lock:
+            if self.list_update_pending:
+                return # The pending broadcast will include this change
+            self.list_update_pending = True
+        timer = threading.Timer(LIST_UPDATE_DELAY, self.broadcast_active_list)
+        timer.daemon = True
+        timer.start()
+
+    def broadcast_active_list(self):
+        with self.lock:
+            self.list_update_pending = False
+        self.broadcast({'type': protocol.CMD_LIST_UPDATE, 'data': self.active_list()})
 
     def handle_client(self, client_socket):
         username = ""
         current_room = "General"
+        session = None
+        logged_out = False
+        # Only used until the connection logs in or resumes, then the session's limiter takes over
+        conn_limiter = RateLimiter()
+        outbox = self.outboxes[client_socket] = Outbox(client_socket)
         
         try:
             while True:
@@ -86,116 +382,186 @@ class ChatServer:
                 cmd = packet['type']
                 data = packet['data']
 
-                if cmd == protocol.CMD_LOGIN:
-                    username = data['username']
-                    with self.lock:
-                        self.clients[client_socket] = username
-                        self.username_to_socket[username] = client_socket
-                        self.rooms["General"]["users"].append(username)
-                    
-                    print(f"[NEW CONN] {username} connected.")
-                    self.send_active_list()
+                # Throttle per user and command class before doing any routing work
+                limiter = session.limiter if session else conn_limiter
+                allowed, delay, limit_class = limiter.check(cmd, data)
+                if (not allowed or delay) and limiter.should_notify(limit_class):
+                    self.notify_throttle(client_socket, limit_class, delay, dropped=not allowed)
+                if not allowed:
+                    continue
 
-                elif cmd == protocol.CMD_MSG:
-                    msg_text = data['text']
-                    to_user = data.get('to')
+                with self.scheduler.turn():
+                    if cmd == protocol.CMD_LOGIN:
+                        username = data['username']
+                        session = self.start_session(username, client_socket)
+                        current_room = session.room
                     
-                    if to_user and to_user != "All":
-                        self.handle_private_msg(username, to_user, msg_text)
-                    else:
-                        # Broadcast to room
-                        payload = {"from": username, "text": msg_text, "room": current_room}
-                        self.broadcast({'type': protocol.CMD_MSG, 'data': payload}, target_room=current_room)
-
-                elif cmd == protocol.CMD_ROOM_JOIN:
-                    new_room = data['room']
-                    password = data.get('password')
+                        print(f"[NEW CONN] {username} connected.")
+                        # The new user sees the list right away, everyone else in the next coalesced update
+                        self.send_active_list(target_socket=client_socket)
+                        self.send_active_list()
+
+                    elif cmd == protocol.CMD_RESUME:
+                        resumed = self.resume_session(client_socket, data.get('token'), data.get('last_seq', 0))
+                        if resumed:
+                            session = resumed
+                            username = session.username
+                            current_room = session.room
+
+                    elif cmd == protocol.CMD_LOGOUT:
+                        logged_out = True
+                        break
+
+                    elif cmd == protocol.CMD_MSG:
+                        msg_text = data['text']
+                        to_user = data.get('to')
                     
-                    with self.lock:
-                        # Check if room exists
-                        if new_room in self.rooms:
-                            # Verify password if one is set
-                            room_pass = self.rooms[new_room]["password"]
-                            if room_pass and room_pass != password:
-                                protocol.send_packet(client_socket, protocol.CMD_MSG, 
-                                                   {"from": "System", "text": f"Incorrect password for {new_room}"})
-                                continue # Skip joining
+                        if to_user and to_user != "All":
+                            self.handle_private_msg(username, to_user, msg_text)
                         else:
-                            # Create new room
-                            self.rooms[new_room] = {"users": [], "password": password}
+                            # Broadcast to room
+                            payload = {"from": username, "text": msg_text, "room": current_room}
+                            self.broadcast({'type': protocol.CMD_MSG, 'data': payload}, target_room=current_room)
 
-                        # Remove from old room
-                        old_room_data = self.rooms.get(current_room)
-                        if old_room_data and username in old_room_data["users"]:
-                            old_room_data["users"].remove(username)
+                    elif cmd == protocol.CMD_ROOM_JOIN:
+                        new_room = data['room']
+                        password = data.get('password')
+                    
+                        with self.lock:
+                            # Check if room exists
+                            if new_room in self.rooms:
+                                # Verify password if one is set
+                                room_pass = self.rooms[new_room]["password"]
+                                if room_pass and room_pass != password:
+                                    self.send(client_socket, protocol.CMD_MSG, 
+                                                       {"from": "System", "text": f"Incorrect password for {new_room}"})
+                                    continue # Skip joining
+                            else:
+                                # Create new room
+                                self.rooms[new_room] = {"users": [], "password": password}
+
+                            # Remove from old room
+                            old_room = current_room
+                            old_room_data = self.rooms.get(current_room)
+                            if old_room_data and username in old_room_data["users"]:
+                                old_room_data["users"].remove(username)
                             
-                        # Add to new room
-                        self.rooms[new_room]["users"].append(username)
-                        current_room = new_room
+                            # Add to new room
+                            self.rooms[new_room]["users"].append(username)
+                            current_room = new_room
+                            if session:
+                                session.room = new_room
                     
-                    self.send_active_list()
-                    # System msg
-                    protocol.send_packet(client_socket, protocol.CMD_MSG, {"from": "System", "text": f"Joined {new_room}"})
-
-                elif cmd == protocol.CMD_FILE:
-                    # Route file to room or user
-                    target_user = data.get('to')
-                    payload = data # Forward entire file payload
-                    payload['from'] = username
+                        # Group calls belong to a room, leaving the room ends your part in it
+                        if old_room != new_room:
+                            if self.leave_group_call(username, old_room):
+                                # Tell the client so it closes its call window and stops uploading
+                                self.send(client_socket, protocol.CMD_GROUP_CALL_UPDATE,
+                                          {"room": old_room, "participants": [], "speakers": [], "ended": True})
+                            if session:
+                                session.call = None
+                        self.send_active_list(target_socket=client_socket)
+                        self.send_active_list()
+                        # System msg
+                        self.send(client_socket, protocol.CMD_MSG, {"from": "System", "text": f"Joined {new_room}"})
+
+                    elif cmd == protocol.CMD_FILE:
+                        # Private files go straight to the user, room files go to the store
+                        target_user = data.get('to')
+                        payload = data # Forward entire file payload
+                        payload['from'] = username
                     
-                    if target_user:
-                         target_sock = self.username_to_socket.get(target_user)
-                         if target_sock:
-                             protocol.send_packet(target_sock, protocol.CMD_FILE, payload)
-                    else:
-                         self.broadcast({'type': protocol.CMD_FILE, 'data': payload}, exclude_socket=client_socket, target_room=current_room)
-
-                # MEDIA ROUTING (Audio/Video Frames)
-                # Highly efficient routing for "Calling"
-                elif cmd in [protocol.CMD_VIDEO, protocol.CMD_AUDIO]:
-                     target = data.get('target')
-                     if target:
-                         target_sock = self.username_to_socket.get(target)
-                         if target_sock:
-                             try:
-                                 # Check if target socket is still valid
-                                 if target_sock.fileno() != -1:
-                                     # Forward directly to target
-                                     packet_to_send = packet 
-                                     # Inject Sender
-                                     packet_to_send['data']['sender'] = username
-                                     protocol.send_packet(target_sock, cmd, packet_to_send['data'], is_encrypted=True)
-                             except Exception as e:
-                                 print(f"[MEDIA ROUTING ERROR] {e}")
+                        if target_user:
+                             self.deliver(target_user, protocol.CMD_FILE, payload)
+                        else:
+                             digest = self.file_store.put(data['content'])
+                             self.announce_file(username, current_room, data['filename'], len(data['content']),
+                                                digest, exclude_socket=client_socket)
+
+                    elif cmd == protocol.CMD_FILE_OFFER:
+                        # Uploader announces a room share by hash first.
+                        # Only ask for the bytes if we don't hold them already.
+                        digest = data.get('hash')
+                        size = self.file_store.size(digest) if is_valid_hash(digest) else None
+                        if size is not None:
+                            # Announce the size we stored, not whatever the client claims
+                            self.announce_file(username, current_room, data.get('filename', "file"), size,
+                                               digest, exclude_socket=client_socket)
+                        else:
+                            self.send(client_socket, protocol.CMD_FILE_FETCH, {"hash": digest})
+
+                    elif cmd == protocol.CMD_FILE_FETCH:
+                        # Recipient wants the content of an announced file
+                        digest = data.get('hash')
+                        content = self.file_store.get(digest)
+                        if content is None:
+                            self.send(client_socket, protocol.CMD_MSG,
+                                                 {"from": "System", "text": f"{data.get('filename')} is no longer available"})
+                        else:
+                            self.send(client_socket, protocol.CMD_FILE,
+                                                 {"from": data.get('from'), "filename": data.get('filename'),
+                                                  "size": len(content), "hash": digest, "content": content})
+
+                    # MEDIA ROUTING (Audio/Video Frames)
+                    # Highly efficient routing for "Calling"
+                    elif cmd in [protocol.CMD_VIDEO, protocol.CMD_AUDIO]:
+                         target = data.get('target')
+                         if data.get('group'):
+                             self.forward_group_media(username, current_room, cmd, data)
+                         elif target:
+                             target_sock = self.username_to_socket.get(target)
+                             if target_sock:
+                                 # Forward directly to target
+                                 packet_to_send = packet 
+                                 # Inject Sender
+                                 packet_to_send['data']['sender'] = username
+                                 self.send(target_sock, cmd, packet_to_send['data'], droppable=True)
                 
-                elif cmd == protocol.CMD_END_CALL:
-                    # Forward end call notification
-                    target = data.get('target')
-                    if target:
-                        target_sock = self.username_to_socket.get(target)
-                        if target_sock:
-                            try:
-                                protocol.send_packet(target_sock, protocol.CMD_END_CALL, {})
-                            except Exception as e:
-                                print(f"[END CALL ERROR] {e}")
+                    elif cmd == protocol.CMD_GROUP_CALL_JOIN:
+                        if self.join_group_call(username, current_room, data):
+                            if session:
+                                session.call = data # Rejoined automatically on RESUME
+                        else:
+                            self.send(client_socket, protocol.CMD_MSG,
+                                                 {"from": "System", "text": f"Could not join the call in {current_room}"})
+
+                    elif cmd == protocol.CMD_GROUP_CALL_LEAVE:
+                        self.leave_group_call(username, current_room)
+                        if session:
+                            session.call = None
+
+                    elif cmd == protocol.CMD_END_CALL:
+                        # Forward end call notification
+                        target = data.get('target')
+                        if target:
+                            target_sock = self.username_to_socket.get(target)
+                            if target_sock:
+                                self.send(target_sock, protocol.CMD_END_CALL, {})
+
+                if delay:
+                    # Stop reading from this client until its byte budget recovers
+                    time.sleep(delay)
 
         except Exception as e:
             print(f"[ERROR] {username}: {e}")
         finally:
             # Cleanup
-            with self.lock:
-                if client_socket in self.clients:
-                    del self.clients[client_socket]
-                if username in self.username_to_socket:
-                    del self.username_to_socket[username]
-                
-                room_data = self.rooms.get(current_room)
-                if room_data and username in room_data["users"]:
-                    room_data["users"].remove(username)
+            if session and session.sock is client_socket:
+                if logged_out:
+                    self.end_session(session)
+                    print(f"[DISCONN] {username}")
+                else:
+                    # Keep the session so the client can RESUME after a network blip
+                    self.park_session(session, client_socket)
+                    print(f"[AWAY] {username} (resumable for {SESSION_GRACE}s)")
+            else:
+                # Never logged in, or the session moved to a newer connection
+                with self.lock:
+                    self.clients.pop(client_socket, None)
             
+            outbox.close()
+            self.outboxes.pop(client_socket, None)
             client_socket.close()
-            self.send_active_list()
-            print(f"[DISCONN] {username}")
 
     def receive(self):
         while True:
@@ -204,4 +570,9 @@ class ChatServer:
             thread.start()
 
 if __name__ == "__main__":
-    ChatServer()
\ No newline at end of file
+    # Set PYCHAT_TRACE=server_trace.json to record per-packet timings
+    with protocol.tracer_from_env() or contextlib.nullcontext():
+        try:
+            ChatServer()
+        except KeyboardInterrupt:
+            print("[SERVER] Shutting down")
\ No newline at end of file
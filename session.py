@@ -0,0 +1,64 @@
+import time
+import secrets
+import threading
+from collections import deque
+
+import protocol
+from ratelimit import RateLimiter
+
+# How long a dropped user keeps their session (name, room, call) for RESUME
+SESSION_GRACE = 60
+# Replay buffer bounds per session
+REPLAY_LIMIT = 200
+REPLAY_MAX_BYTES = 4 * 1024 * 1024
+# Packets worth replaying after a reconnect. Media, lists and system notices are not.
+REPLAYED_COMMANDS = (protocol.CMD_MSG, protocol.CMD_FILE, protocol.CMD_FILE_OFFER)
+
+class Session:
+    """
+    A logged-in user, independent of the socket they are connected on.
+    Replayable packets sent to the user are numbered (sseq) and kept in a
+    bounded buffer so a client that reconnects with RESUME only gets what
+    it missed.
+    """
+    def __init__(self, username, sock):
+        self.token = secrets.token_urlsafe(16)
+        self.username = username
+        self.sock = sock # None while the user is away
+        self.room = "General"
+        self.call = None # GROUP_CALL_JOIN data while in a group call
+        self.away_since = None
+        self.seq = 0
+        self.replay = deque() # (sseq, cmd, data, size)
+        self.replay_bytes = 0
+        # Rate limits belong to the user, so reconnecting doesn't refill the buckets
+        self.limiter = RateLimiter()
+        # Held by the server while numbering + queueing a packet, and while replaying on RESUME
+        self.lock = threading.RLock()
+
+    def record(self, cmd, data):
+        """ Numbers a packet for this user and keeps it for replay. Returns the numbered copy. """
+        with self.lock:
+            self.seq += 1
+            data = dict(data, sseq=self.seq)
+            size = len(data.get('content') or b'') + 64
+            self.replay.append((self.seq, cmd, data, size))
+            self.replay_bytes += size
+            while self.replay and (len(self.replay) > REPLAY_LIMIT or self.replay_bytes > REPLAY_MAX_BYTES):
+                self.replay_bytes -= self.replay.popleft()[3]
+            return data
+
+    def missed(self, last_seq):
+        """ Returns ([(cmd, data)] after last_seq, whether older packets were already dropped) """
+        with self.lock:
+            packets = [(cmd, data) for seq, cmd, data, _ in self.replay if seq > last_seq]
+            oldest = self.replay[0][0] if self.replay else self.seq + 1
+            gap = last_seq < self.seq and oldest > last_seq + 1
+            return packets, gap
+
+    def park(self):
+        self.sock = None
+        self.away_since = time.monotonic()
+
+    def expired(self, now):
+        return self.sock is None and now - self.away_since > SESSION_GRACE